@@ -1,21 +1,78 @@
-from fastapi import Security, HTTPException, status
-from fastapi.security import APIKeyHeader
-from typing import Optional
+import hmac
+import json
+
+from fastapi import status
 
 # Ваш секретный ключ API
 API_KEY = "secret-api-key-12345"
+# Байтовое представление ключа вычисляется один раз при импорте модуля
+API_KEY_BYTES = API_KEY.encode("ascii")
+
+# Ключ берется из заголовка с именем X-API-Key.
+# В ASGI имена заголовков передаются в нижнем регистре в виде байтов
+API_KEY_HEADER = "X-API-Key"
+API_KEY_HEADER_BYTES = API_KEY_HEADER.lower().encode("ascii")
+
+# Методы, изменяющие данные, требуют API ключ; чтение (GET) доступно всем
+PROTECTED_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+
+# Описание схемы безопасности для OpenAPI (кнопка Authorize в Swagger UI)
+API_KEY_SECURITY_SCHEME_NAME = "APIKeyHeader"
+API_KEY_SECURITY_SCHEME = {"type": "apiKey", "in": "header", "name": API_KEY_HEADER}
+
+
+def _error_body(detail: str) -> bytes:
+    return json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+
+
+# Тела ответов 403 формируются один раз при импорте
+_MISSING_KEY_BODY = _error_body("Not authenticated")
+_INVALID_KEY_BODY = _error_body(
+    "Неверный API ключ. Требуется заголовок X-API-Key с правильным значением."
+)
 
-# Определяем, что ключ будет браться из заголовка с именем X-API-Key
-api_key_header = APIKeyHeader(name="X-API-Key", auto_error=True)
 
-async def verify_api_key(api_key: str = Security(api_key_header)):
+class APIKeyMiddleware:
     """
-    Проверка API ключа, переданного в заголовке X-API-Key.
-    Если ключ неверный, возвращается ошибка 403 Forbidden.
+    ASGI middleware для проверки API ключа, переданного в заголовке X-API-Key.
+    Проверяет только запросы, изменяющие данные (POST, PUT, PATCH, DELETE).
+    Если ключ отсутствует или неверный, возвращается ошибка 403 Forbidden
+    до маршрутизации запроса.
     """
-    if api_key != API_KEY:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Неверный API ключ. Требуется заголовок X-API-Key с правильным значением."
-        )
-    return api_key
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in PROTECTED_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        api_key = None
+        for name, value in scope["headers"]:
+            if name == API_KEY_HEADER_BYTES:
+                api_key = value
+                break
+
+        if not api_key:
+            await self._forbidden(send, _MISSING_KEY_BODY)
+            return
+
+        # Сравнение за постоянное время (защита от timing-атак)
+        if not hmac.compare_digest(api_key, API_KEY_BYTES):
+            await self._forbidden(send, _INVALID_KEY_BODY)
+            return
+
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    async def _forbidden(send, body: bytes):
+        await send({
+            "type": "http.response.start",
+            "status": status.HTTP_403_FORBIDDEN,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
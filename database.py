@@ -1,19 +1,55 @@
-from sqlalchemy import create_engine, Column, Integer, String
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event, insert, Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
 
 # 1. Настройка подключения к базе данных SQLite
 # Файл books.db будет создан в корневой папке проекта
 SQLALCHEMY_DATABASE_URL = "sqlite:///./books.db"
+# Файл блокировки, через который рабочие процессы по очереди инициализируют базу
+DB_INIT_LOCK_PATH = "./books.db.lock"
 
 # connect_args={"check_same_thread": False} требуется только для SQLite,
-# чтобы разрешить множественные запросы в одном потоке (как в FastAPI)
+# чтобы разрешить множественные запросы в одном потоке (как в FastAPI).
+# Пул соединений настроен явно: соединения (и отображения файлов WAL)
+# переиспользуются между запросами, а не открываются заново
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=10,
+    max_overflow=20,
+    pool_recycle=3600,
+    pool_pre_ping=True
 )
 
+
+# Настройки SQLite применяются к каждому новому соединению пула:
+# WAL позволяет читателям не ждать писателя, остальные параметры
+# уменьшают число синхронизаций с диском и обращений к файлу
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 # 2. Настройка сессии
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: после commit объекты сохраняют значения полей,
+# и ответ строится без повторного SELECT (вместо db.refresh)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 # 3. Базовый класс для моделей
 Base = declarative_base()
@@ -26,55 +62,116 @@ class BookDB(Base):
     Соответствует таблице 'books' в SQLite.
     """
     __tablename__ = "books"
+    # Значения, сгенерированные базой при INSERT/UPDATE, возвращаются
+    # в том же запросе (RETURNING), без отдельного SELECT
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(200), nullable=False)
     author = Column(String(100), nullable=False)
-    year = Column(Integer, nullable=False)
+    year = Column(Integer, nullable=False, index=True)
     isbn = Column(String(13), nullable=True)
 
 
-# 5. Создание таблиц в базе данных
-Base.metadata.create_all(bind=engine)
-
-
-# 6. Функция для инициализации базы данных стартовыми данными (вызывается один раз)
+# 5. Функция для инициализации базы данных стартовыми данными (вызывается один раз)
 def initialize_db_data(db: Session):
     """
     Добавляет начальные книги, если таблица пуста.
     """
-    # Проверяем, пуста ли таблица
-    if db.query(BookDB).count() == 0:
+    # Проверяем, пуста ли таблица: достаточно найти первую строку,
+    # полный подсчет через count(*) не нужен
+    if db.query(BookDB.id).first() is None:
         initial_books = [
             {"title": "Война и мир", "author": "Лев Толстой", "year": 1869, "isbn": "9785170987654"},
             {"title": "Преступление и наказание", "author": "Федор Достоевский", "year": 1866, "isbn": "9785170876543"},
             {"title": "Евгений Онегин", "author": "Александр Пушкин", "year": 1833, "isbn": "9785170765432"}
         ]
 
-        for book_data in initial_books:
-            db_book = BookDB(**book_data)
-            db.add(db_book)
-
+        # Одна вставка через Core (executemany) без создания ORM-объектов
+        db.execute(insert(BookDB), initial_books)
         db.commit()
 
 
-# Запускаем инициализацию данных сразу после создания таблиц
-# Мы создаем временную сессию для этой операции
-try:
-    db = SessionLocal()
-    initialize_db_data(db)
-finally:
-    db.close()
+@contextmanager
+def init_lock():
+    """
+    Межпроцессная блокировка на время инициализации базы данных.
+    Рабочие процессы uvicorn/gunicorn запускаются одновременно, и без нее
+    они параллельно выполняют create_all и добавляют стартовые книги.
+    """
+    with open(DB_INIT_LOCK_PATH, "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# 6. Создание таблиц и заполнение стартовыми данными.
+# Вызывается при запуске приложения (см. lifespan в main.py), а не при импорте
+# модуля, чтобы импорт не открывал базу данных в каждом рабочем процессе
+def init_db():
+    """
+    Создает таблицы, если их еще нет, и добавляет начальные книги.
+    Процессы выполняют инициализацию по очереди: первый создает таблицы
+    и стартовые данные, остальные видят, что все уже готово.
+    """
+    with init_lock():
+        _create_schema_and_seed()
+
+
+def _create_schema_and_seed():
+    Base.metadata.create_all(bind=engine)
+
+    # create_all не добавляет индексы в уже существующую таблицу,
+    # поэтому недостающие индексы создаются отдельно (IF NOT EXISTS)
+    with engine.begin() as connection:
+        for index in BookDB.__table__.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
 
+    # Создаем временную сессию для этой операции
+    with SessionLocal() as db:
+        initialize_db_data(db)
 
-# 7. Функция-зависимость для получения сессии базы данных
-def get_db():
+
+# 7. Сессия базы данных, привязанная к текущему запросу.
+# Вместо зависимости Depends(get_db) обработчики используют db_session напрямую.
+# Область видимости сессии задается переменной контекста, а не потоком:
+# FastAPI выполняет обработчики в пуле потоков и копирует туда контекст,
+# поэтому обработчик и middleware работают с одной и той же сессией
+_request_scope: ContextVar[Optional[object]] = ContextVar("request_scope", default=None)
+
+db_session = scoped_session(SessionLocal, scopefunc=_request_scope.get)
+
+
+class DBSessionMiddleware:
     """
-    Предоставляет сессию базы данных для каждого запроса.
-    Гарантирует закрытие сессии после завершения запроса.
+    ASGI middleware, которое открывает область сессии на время запроса.
+    Гарантирует закрытие сессии после отправки ответа (в том числе потокового).
     """
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = _request_scope.set(object())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # Закрытие сессии возвращает соединение в пул, а пул выполняет
+            # rollback: это блокирующий вызов SQLite, поэтому он уходит в пул
+            # потоков. Контекст копируется, и scopefunc находит ту же сессию
+            await run_in_threadpool(db_session.remove)
+            _request_scope.reset(token)
@@ -1,32 +1,88 @@
-from fastapi import FastAPI, HTTPException, status, Depends
-from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime
-from collections import Counter
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from database import get_db, BookDB
-from auth import verify_api_key  # <-- Добавлен импорт для аутентификации
+import hashlib
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Response, status
+from fastapi.openapi.utils import get_openapi
+import orjson
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+from typing import Iterator, List, Optional
+from datetime import date
+from sqlalchemy import func, select, update, Result
+from database import db_session, init_db, BookDB, DBSessionMiddleware
+from auth import (  # <-- Добавлен импорт для аутентификации
+    APIKeyMiddleware,
+    API_KEY_SECURITY_SCHEME,
+    API_KEY_SECURITY_SCHEME_NAME,
+    PROTECTED_METHODS
+)
+
+# Переменная окружения, которую выставляет точка входа (__main__) после
+# инициализации базы: рабочие процессы uvicorn наследуют ее и не повторяют
+# create_all и заполнение стартовыми данными. При запуске через
+# `uvicorn main:app --workers N` или gunicorn переменная не задана,
+# и одновременный запуск init_db() в рабочих процессах упорядочивает
+# файловая блокировка (см. database.init_lock)
+DB_INITIALIZED_ENV = "BOOKS_DB_INITIALIZED"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Инициализирует базу данных при запуске приложения.
+    """
+    if not os.getenv(DB_INITIALIZED_ENV):
+        init_db()
+    yield
+
 
 # Создание экземпляра приложения FastAPI
 app = FastAPI(
     title="Books API",
     description="REST API для управления библиотекой книг на SQLAlchemy",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    # Ответы сериализуются через orjson вместо стандартного json.dumps
+    default_response_class=ORJSONResponse
 )
 
+# Сессия базы данных создается на время запроса и закрывается после ответа
+app.add_middleware(DBSessionMiddleware)
+# Проверка API ключа для POST, PUT, PATCH и DELETE выполняется до маршрутизации
+app.add_middleware(APIKeyMiddleware)
+# Сжатие ответов, если клиент передал Accept-Encoding: gzip.
+# Обычные ответы меньше 500 байт не сжимаются; потоковые ответы
+# (большие страницы списка книг) сжимаются всегда
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
+
+def validate_year(year: Optional[int]) -> Optional[int]:
+    """
+    Проверяет, что год издания не больше текущего.
+    Текущий год берется в момент проверки, а не при импорте модуля,
+    поэтому граница не устаревает при смене года без перезапуска.
+    """
+    current_year = date.today().year
+    if year is not None and year > current_year:
+        raise ValueError(f"Год издания не может быть больше {current_year}")
+    return year
+
 
-# Модель данных для книги (Pydantic схема)
-class Book(BaseModel):
-    id: Optional[int] = None
+# Модель книги в ответах API (Pydantic схема): id всегда присвоен базой
+class BookRead(BaseModel):
+    id: int = Field(..., description="Идентификатор книги")
     title: str = Field(..., min_length=1, max_length=200, description="Название книги")
     author: str = Field(..., min_length=1, max_length=100, description="Автор книги")
-    year: int = Field(..., ge=1000, le=datetime.now().year, description="Год издания")
+    year: int = Field(..., ge=1000, description="Год издания")
     isbn: Optional[str] = Field(None, min_length=10, max_length=13, description="ISBN книги")
 
     class Config:
         json_schema_extra = {
             "example": {
+                "id": 1,
                 "title": "Мастер и Маргарита",
                 "author": "Михаил Булгаков",
                 "year": 1967,
@@ -36,15 +92,113 @@ class Book(BaseModel):
         # Важно для работы с SQLAlchemy ORM моделями
         from_attributes = True
 
-    # Модель для обновления книги (все поля опциональны)
 
+# Модель для создания и полной замены книги: поля id в ней нет,
+# поэтому model_dump() передается в ORM-модель без exclude
+class BookCreate(BaseModel):
+    title: str = Field(..., min_length=1, max_length=200, description="Название книги")
+    author: str = Field(..., min_length=1, max_length=100, description="Автор книги")
+    year: int = Field(..., ge=1000, description="Год издания")
+    isbn: Optional[str] = Field(None, min_length=10, max_length=13, description="ISBN книги")
+
+    _check_year = field_validator("year")(validate_year)
 
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "title": "Мастер и Маргарита",
+                "author": "Михаил Булгаков",
+                "year": 1967,
+                "isbn": "9785170123456"
+            }
+        }
+
+
+# Модель для обновления книги (все поля опциональны)
 class BookUpdate(BaseModel):
     title: Optional[str] = Field(None, min_length=1, max_length=200)
     author: Optional[str] = Field(None, min_length=1, max_length=100)
-    year: Optional[int] = Field(None, ge=1000, le=datetime.now().year)
+    year: Optional[int] = Field(None, ge=1000)
     isbn: Optional[str] = Field(None, min_length=10, max_length=13)
 
+    _check_year = field_validator("year")(validate_year)
+
+
+def book_to_dict(book: BookDB) -> dict:
+    """
+    Преобразует ORM-объект книги в словарь для ответа.
+    Обработчики чтения возвращают готовый Response: так схема BookRead
+    проверяется один раз, а не повторно при сериализации по response_model.
+    response_model остается в декораторах для документации OpenAPI.
+    """
+    return BookRead.model_validate(book).model_dump()
+
+
+# Количество строк, которое выбирается из базы и отправляется клиенту за раз
+STREAM_BATCH_SIZE = 128
+
+
+def stream_books(result: Result) -> Iterator[bytes]:
+    """
+    Отдает строки результата как JSON-массив по частям.
+    В памяти одновременно находится только одна пачка строк,
+    а выборка из базы чередуется с отправкой данных клиенту.
+    """
+    try:
+        yield b"["
+        separator = b""
+        for rows in result.partitions():
+            yield separator + b",".join(orjson.dumps(row._asdict()) for row in rows)
+            separator = b","
+        yield b"]"
+    finally:
+        result.close()
+
+
+# Заголовок кэширования для списка книг и статистики
+PUBLIC_CACHE_CONTROL = "public, max-age=30"
+
+# Кэш статистики в памяти процесса: (поколение данных, время истечения, значение).
+# Поколение увеличивается после каждого изменения книг через API, и кэш
+# сразу становится недействительным. TTL ограничивает устаревание, если
+# данные изменил другой рабочий процесс со своим кэшем
+STATS_CACHE_TTL = 30
+_stats_cache = {"generation": 0, "entry": (None, 0.0, None)}
+_stats_cache_lock = threading.Lock()
+
+
+def invalidate_stats_cache():
+    """
+    Сбрасывает кэш статистики. Вызывается после commit в эндпоинтах записи.
+    """
+    with _stats_cache_lock:
+        _stats_cache["generation"] += 1
+
+
+def book_etag(book: BookDB) -> str:
+    """
+    Вычисляет слабый ETag книги по значениям всех ее полей.
+    ETag слабый, потому что GZipMiddleware может сжать ответ, а строгий
+    валидатор должен различать тела с разным кодированием (RFC 9110 §8.8.1).
+    """
+    # JSON-массив однозначно разделяет поля, даже если они содержат ":"
+    data = orjson.dumps((book.id, book.title, book.author, book.year, book.isbn))
+    return f'W/"{hashlib.blake2b(data, digest_size=8).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Проверяет, совпадает ли ETag с одним из значений заголовка If-None-Match.
+    Для If-None-Match используется слабое сравнение (префикс W/ не учитывается).
+    """
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(
+        value.strip().removeprefix("W/") == opaque_tag
+        for value in if_none_match.split(",")
+    )
+
 
 # Корневой эндпоинт
 @app.get("/", tags=["Root"])
@@ -60,10 +214,13 @@ async def root():
     }
 
 
+# Эндпоинты, работающие с базой данных, объявлены через обычный def:
+# сессия SQLAlchemy синхронная, и FastAPI выполняет такие обработчики
+# в пуле потоков, не блокируя цикл событий.
+
 # --- ЭНДПОИНТЫ ЧТЕНИЯ (НЕ ТРЕБУЮТ АУТЕНТИФИКАЦИИ) ---
-@app.get("/api/books", response_model=List[Book], tags=["Books"])
-async def get_books(
-        db: Session = Depends(get_db),
+@app.get("/api/books", response_model=List[BookRead], tags=["Books"])
+def get_books(
         skip: int = 0,
         limit: int = 10,
         author: Optional[str] = None,
@@ -74,90 +231,136 @@ async def get_books(
     Получить список книг с фильтрацией и пагинацией из базы данных.
     """
 
-    query = db.query(BookDB)
+    # Выбираются только столбцы, а не ORM-объекты: строки не проходят
+    # через identity map и сразу сериализуются в JSON
+    query = select(BookDB.id, BookDB.title, BookDB.author, BookDB.year, BookDB.isbn)
 
     if author:
-        query = query.filter(BookDB.author.ilike(f"%{author}%"))
+        # Поиск подстроки (LIKE '%...%') не может использовать индекс:
+        # это полный просмотр таблицы, пока не добавлен полнотекстовый поиск
+        query = query.where(BookDB.author.ilike(f"%{author}%"))
 
     if year_from:
-        query = query.filter(BookDB.year >= year_from)
+        query = query.where(BookDB.year >= year_from)
 
     if year_to:
-        query = query.filter(BookDB.year <= year_to)
-
-    books = query.offset(skip).limit(limit).all()
+        query = query.where(BookDB.year <= year_to)
+
+    # Явный порядок нужен для стабильной пагинации: с индексом по году
+    # SQLite может вернуть строки в порядке индекса, а не по id
+    query = query.order_by(BookDB.id).offset(skip).limit(limit)
+
+    # Страница не больше одной пачки отдается обычным ответом: его размер
+    # известен заранее, и GZipMiddleware не сжимает маленькие ответы.
+    # Потоковый ответ сжимается всегда, независимо от minimum_size
+    if limit <= STREAM_BATCH_SIZE:
+        rows = db_session.execute(query).all()
+        return ORJSONResponse(
+            content=[row._asdict() for row in rows],
+            headers={"Cache-Control": PUBLIC_CACHE_CONTROL}
+        )
 
-    return books
+    result = db_session.execute(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+    return StreamingResponse(
+        stream_books(result),
+        media_type="application/json",
+        headers={"Cache-Control": PUBLIC_CACHE_CONTROL}
+    )
 
 
 @app.get("/api/books/stats", tags=["Statistics"])
-async def get_statistics(db: Session = Depends(get_db)):
+def get_statistics(response: Response):
     """
     Получить статистику по книгам из базы данных.
     """
-    all_books = db.query(BookDB).all()
-    total_books = len(all_books)
-    authors = Counter(book.author for book in all_books)
-    centuries = Counter(book.year // 100 + 1 for book in all_books)
+    response.headers["Cache-Control"] = PUBLIC_CACHE_CONTROL
 
-    return {
+    # Поколение читается до запросов к базе: если книги изменятся во время
+    # пересчета, сохраненный результат сразу окажется устаревшим
+    generation = _stats_cache["generation"]
+    now = time.monotonic()
+    cached_generation, expires_at, cached_stats = _stats_cache["entry"]
+    if cached_generation == generation and now < expires_at:
+        return cached_stats
+
+    # Агрегация выполняется в SQLite (GROUP BY): из базы приходят только
+    # итоговые группы, ORM-объекты книг не создаются
+    century_expr = (BookDB.year // 100 + 1).label("century")
+
+    total_books = db_session.query(func.count(BookDB.id)).scalar()
+    authors = db_session.query(BookDB.author, func.count(BookDB.id)).group_by(BookDB.author).all()
+    centuries = db_session.query(century_expr, func.count(BookDB.id)).group_by(century_expr).all()
+
+    stats = {
         "total_books": total_books,
         "books_by_author": dict(authors),
         "books_by_century": {
             f"{century} век": count
-            for century, count in centuries.items()
+            for century, count in centuries
         }
     }
+    _stats_cache["entry"] = (generation, now + STATS_CACHE_TTL, stats)
+    return stats
 
 
-@app.get("/api/books/{book_id}", response_model=Book, tags=["Books"])
-async def get_book(book_id: int, db: Session = Depends(get_db)):
+@app.get("/api/books/{book_id}", response_model=BookRead, tags=["Books"])
+def get_book(book_id: int, if_none_match: Optional[str] = Header(None)):
     """
     Получить книгу по ID из базы данных.
+    Поддерживает условные запросы: если ETag совпадает с заголовком
+    If-None-Match, возвращается 304 Not Modified без тела ответа.
     """
-    book = db.query(BookDB).filter(BookDB.id == book_id).first()
+    book = db_session.get(BookDB, book_id)
 
     if book is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Книга с ID {book_id} не найдена"
         )
-    return book
+
+    etag = book_etag(book)
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    return ORJSONResponse(content=book_to_dict(book), headers={"ETag": etag})
 
 
 # --- ЭНДПОИНТЫ ЗАПИСИ (ТРЕБУЮТ АУТЕНТИФИКАЦИИ) ---
 
 # POST /api/books - Создание новой книги
-@app.post("/api/books", response_model=Book, status_code=status.HTTP_201_CREATED,
+@app.post("/api/books", response_model=BookRead, status_code=status.HTTP_201_CREATED,
           tags=["Books"])
-async def create_book(
-        book: Book,
-        db: Session = Depends(get_db),
-        api_key: str = Depends(verify_api_key)  # <-- Защита: требуется API ключ
+def create_book(
+        book: BookCreate
 ):
     """
     Создать новую книгу в базе данных (требуется аутентификация).
     """
-    db_book = BookDB(**book.model_dump(exclude={"id"}))
+    db_book = BookDB(**book.model_dump())
 
-    db.add(db_book)
-    db.commit()
-    db.refresh(db_book)
+    db_session.add(db_book)
+    db_session.commit()
+    invalidate_stats_cache()
     return db_book
 
 
 # PUT /api/books/{book_id} - Полное обновление книги
-@app.put("/api/books/{book_id}", response_model=Book, tags=["Books"])
-async def update_book(
+@app.put("/api/books/{book_id}", response_model=BookRead, tags=["Books"])
+def update_book(
         book_id: int,
-        updated_book: Book,
-        db: Session = Depends(get_db),
-        api_key: str = Depends(verify_api_key)  # <-- Защита: требуется API ключ
+        updated_book: BookCreate
 ):
     """
     Полностью обновить информацию о книге в базе данных (требуется аутентификация).
     """
-    db_book = db.query(BookDB).filter(BookDB.id == book_id).first()
+    # Один запрос UPDATE ... RETURNING вместо выборки книги и изменения
+    # ее атрибутов: если книги нет, RETURNING не вернет ни одной строки
+    db_book = db_session.execute(
+        update(BookDB)
+        .where(BookDB.id == book_id)
+        .values(**updated_book.model_dump())
+        .returning(BookDB)
+    ).scalar_one_or_none()
 
     if db_book is None:
         raise HTTPException(
@@ -165,26 +368,37 @@ async def update_book(
             detail=f"Книга с ID {book_id} не найдена"
         )
 
-    for field, value in updated_book.model_dump(exclude={"id"}).items():
-        setattr(db_book, field, value)
-
-    db.commit()
-    db.refresh(db_book)
+    db_session.commit()
+    invalidate_stats_cache()
     return db_book
 
 
 # PATCH /api/books/{book_id} - Частичное обновление книги
-@app.patch("/api/books/{book_id}", response_model=Book, tags=["Books"])
-async def partial_update_book(
+@app.patch("/api/books/{book_id}", response_model=BookRead, tags=["Books"])
+def partial_update_book(
         book_id: int,
-        book_update: BookUpdate,
-        db: Session = Depends(get_db),
-        api_key: str = Depends(verify_api_key)  # <-- Защита: требуется API ключ
+        book_update: BookUpdate
 ):
     """
     Частично обновить информацию о книге в базе данных (требуется аутентификация).
     """
-    db_book = db.query(BookDB).filter(BookDB.id == book_id).first()
+    update_data = {
+        field: value
+        for field, value in book_update.model_dump(exclude_unset=True).items()
+        if value is not None
+    }
+
+    # Если обновлять нечего, книга только читается; иначе выполняется
+    # один запрос UPDATE ... RETURNING, как в update_book
+    if update_data:
+        db_book = db_session.execute(
+            update(BookDB)
+            .where(BookDB.id == book_id)
+            .values(**update_data)
+            .returning(BookDB)
+        ).scalar_one_or_none()
+    else:
+        db_book = db_session.get(BookDB, book_id)
 
     if db_book is None:
         raise HTTPException(
@@ -192,27 +406,21 @@ async def partial_update_book(
             detail=f"Книга с ID {book_id} не найдена"
         )
 
-    update_data = book_update.model_dump(exclude_unset=True)
-    for field, value in update_data.items():
-        if hasattr(db_book, field) and value is not None:
-            setattr(db_book, field, value)
-
-    db.commit()
-    db.refresh(db_book)
+    if update_data:
+        db_session.commit()
+        invalidate_stats_cache()
     return db_book
 
 
 # DELETE /api/books/{book_id} - Удаление книги
 @app.delete("/api/books/{book_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Books"])
-async def delete_book(
-        book_id: int,
-        db: Session = Depends(get_db),
-        api_key: str = Depends(verify_api_key)  # <-- Защита: требуется API ключ
+def delete_book(
+        book_id: int
 ):
     """
     Удалить книгу по ID из базы данных (требуется аутентификация).
     """
-    db_book = db.query(BookDB).filter(BookDB.id == book_id).first()
+    db_book = db_session.get(BookDB, book_id)
 
     if db_book is None:
         raise HTTPException(
@@ -220,13 +428,58 @@ async def delete_book(
             detail=f"Книга с ID {book_id} не найдена"
         )
 
-    db.delete(db_book)
-    db.commit()
+    db_session.delete(db_book)
+    db_session.commit()
+    invalidate_stats_cache()
     return
 
 
+def custom_openapi():
+    """
+    Генерирует схему OpenAPI и добавляет в нее схему безопасности X-API-Key
+    для защищенных операций. API ключ проверяет APIKeyMiddleware, а не
+    зависимости обработчиков, поэтому FastAPI не добавляет ее сам.
+    """
+    if app.openapi_schema is None:
+        openapi_schema = get_openapi(
+            title=app.title,
+            version=app.version,
+            description=app.description,
+            routes=app.routes
+        )
+        openapi_schema.setdefault("components", {})["securitySchemes"] = {
+            API_KEY_SECURITY_SCHEME_NAME: API_KEY_SECURITY_SCHEME
+        }
+        for path_item in openapi_schema["paths"].values():
+            for method, operation in path_item.items():
+                if method.upper() in PROTECTED_METHODS:
+                    operation["security"] = [{API_KEY_SECURITY_SCHEME_NAME: []}]
+        app.openapi_schema = openapi_schema
+    return app.openapi_schema
+
+
+app.openapi = custom_openapi
+
+
 # Точка входа для запуска приложения
 if __name__ == "__main__":
+    import sys
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # База инициализируется один раз в главном процессе до запуска рабочих
+    init_db()
+    os.environ[DB_INITIALIZED_ENV] = "1"
+
+    # uvloop + httptools задаются явно, чтобы не откатываться молча на asyncio/h11.
+    # uvloop не поддерживает Windows, там остается стандартный цикл asyncio.
+    # Журнал доступа отключен: он пишет строку на каждый запрос.
+    # Количество процессов задается переменной окружения WEB_CONCURRENCY.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        access_log=False,
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
+    )